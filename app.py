@@ -1,73 +1,148 @@
 """簡易な意味検索Webアプリ。
-- 起動時に問題文を数値ベクトル化して保持
+- 起動時に問題文を数値ベクトル化して保持（2-gramのハッシュ結果を cache/ に保存し再利用）
 - 検索文も同じ方法でベクトル化
-- コサイン類似度で近い順に上位10件を返す
+- コサイン類似度で近い順に上位10件を返す（NumPyの行列積で一括計算）
 - 問題詳細ページで選択肢/答え表示のトグルに対応
 """
 
 from __future__ import annotations
 
+import functools
 import hashlib
 import json
 import math
+import os
+import tempfile
+import zipfile
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import parse_qs, unquote, urlparse
 
+import numpy as np
+
+try:  # 任意：入っていればJSONの書き出しを高速化
+    import orjson
+except ImportError:  # なければ標準ライブラリのjsonを使う
+    orjson = None
+
 # -----------------------------
 # 設定値（最小構成）
 # -----------------------------
 DATA_PATH = Path("data/problems.json")
 INDEX_PATH = Path("static/index.html")
 PROBLEM_PAGE_PATH = Path("static/problem.html")
-VECTOR_SIZE = 128  # 「意味を表す数字の列」の長さ（固定長）
+CACHE_DIR = Path("cache")  # 問題文の2-gramハッシュ結果の保存先（再起動時の再計算を省略）
+VECTORIZER_VERSION = 2  # ハッシュの方法を変えたら上げる（保存済みの結果を無効化）
+VECTOR_SIZE = 128  # 「意味を表す数字の列」の長さ（固定長、2のべき乗）
 TOP_K = 10
+QUERY_CACHE_SIZE = 1024  # 検索文ベクトルを覚えておく件数（LRU）
 HOST = "0.0.0.0"
 PORT = 8000
+SENDFILE_MIN_SIZE = 16 * 1024  # これ以上大きい静的ページはsendfileでそのまま送る
 
 
 # -----------------------------
 # テキスト -> 数値ベクトル 変換
 # -----------------------------
 def _normalize_text(text: str) -> str:
-    """前処理：空白などを軽く整える（日本語向けに簡易対応）"""
-    return "".join((text or "").lower().split())
+    """前処理：空白などを軽く整える（日本語向けに簡易対応）
+
+    str.split()は全角空白(U+3000)も含むUnicodeの空白すべてで区切る。
+    空白を除いてから小文字化して、lower()が処理する文字数を減らす。
+    """
+    if not text:
+        return ""
+    return "".join(text.split()).lower()
 
 
-def _char_bigrams(text: str) -> List[str]:
-    """文字2-gramを作る（日本語でも最低限の意味手がかりになる）"""
-    if len(text) < 2:
-        return [text]
-    return [text[i : i + 2] for i in range(len(text) - 1)]
+# ハッシュの上位ビットをそのままインデックスにするため、2のべき乗でないと
+# VECTOR_SIZE以上の値が出て行列の別の行に数えられてしまう
+if VECTOR_SIZE <= 0 or VECTOR_SIZE & (VECTOR_SIZE - 1):
+    raise ValueError(f"VECTOR_SIZE must be a power of two, got {VECTOR_SIZE}")
 
+# 文字コードの組を混ぜる乗算ハッシュの定数（黄金比由来の奇数）
+_HASH_MULTIPLIER = np.uint32(2654435761)
+_HASH_SHIFT = np.uint32(32 - (VECTOR_SIZE - 1).bit_length())
 
-def _hash_to_index(token: str) -> int:
-    """トークンを固定長ベクトルのインデックスへ（再現性のあるハッシュ）"""
-    digest = hashlib.md5(token.encode("utf-8")).digest()
-    value = int.from_bytes(digest[:4], "little")
-    return value % VECTOR_SIZE
 
+def _char_bigram_indices(text: str) -> np.ndarray:
+    """文字2-gramを固定長ベクトルのインデックス列へ（再現性のあるハッシュ）
 
-def text_to_vector(text: str) -> List[float]:
-    """テキストを「意味を表す数字の列」に変換"""
-    normalized = _normalize_text(text)
-    bigrams = _char_bigrams(normalized)
+    文字をコードポイントの配列にし、隣り合う2文字を乗算ハッシュで混ぜて
+    上位ビットを取る。2-gramの文字列を作らずNumPyの配列演算だけで済む。
+    1文字しかない場合はその1文字を1トークンとして扱う。
+    """
+    codepoints = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    if len(codepoints) == 1:
+        codepoints = np.append(codepoints, np.uint32(0))
+    mixed = (codepoints[:-1] * _HASH_MULTIPLIER) ^ codepoints[1:]
+    return ((mixed * _HASH_MULTIPLIER) >> _HASH_SHIFT).astype(np.intp)
 
-    vec = [0.0] * VECTOR_SIZE
-    for token in bigrams:
-        vec[_hash_to_index(token)] += 1.0
 
-    norm = math.sqrt(sum(v * v for v in vec))
-    if norm == 0.0:
-        return vec
-    return [v / norm for v in vec]
+def _bigram_counts(text: str) -> np.ndarray:
+    """テキストの2-gram出現回数を固定長ベクトルに集計（正規化なし）"""
+    indices = _char_bigram_indices(_normalize_text(text))
+    # 結果はLRUキャッシュに残るので毎回新しい配列が要る。
+    # 使い回しのバッファに書いてコピーするより、bincountで直接作る方が速い。
+    return np.bincount(indices, minlength=VECTOR_SIZE).astype(np.float32)
 
 
-def cosine_similarity(vec_a: List[float], vec_b: List[float]) -> float:
-    """コサイン類似度（内積）"""
-    return sum(a * b for a, b in zip(vec_a, vec_b))
+def text_to_vector_normalized(text: str) -> np.ndarray:
+    """テキストを「意味を表す数字の列」に変換（L2正規化済み）
+
+    DOC_MATRIXの各行と同じ形のベクトルになるので、cosine_similarityに渡せる。
+    """
+    vec = _bigram_counts(text)
+    # 1本だけならnp.linalg.normより自分自身との内積＋sqrtの方が軽い
+    squared = float(np.dot(vec, vec))
+    if squared > 0.0:
+        vec *= 1.0 / math.sqrt(squared)
+    return vec
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def text_to_vector_unnormalized(text: str) -> np.ndarray:
+    """検索文用のベクトル（正規化なし）
+
+    問題側のベクトル（DOC_MATRIXの各行）は_doc_matrix_from_csrで正規化済み
+    なので、並び順を決めるだけなら検索文の長さで割る必要はない
+    （全問題に同じ定数が掛かるだけ）。
+    同じ検索文は何度も来やすいので、結果をLRUで使い回す。
+    """
+    vec = _bigram_counts(text)
+    # キャッシュで共有されるため、誤って書き換えられないよう読み取り専用にする
+    vec.setflags(write=False)
+    return vec
+
+
+def cosine_similarity(vec_a: np.ndarray, vec_b: np.ndarray) -> float:
+    """コサイン類似度（正規化済みベクトル同士なので内積と同じ）
+
+    text_to_vector_normalizedの出力やDOC_MATRIXの行を渡すこと。
+    text_to_vector_unnormalizedの出力では単なる回数の内積になる。
+    """
+    return float(np.vdot(vec_a, vec_b))
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコアの高い順に上位k件の行番号を返す（同点は行番号の小さい順）
+
+    全件ソートはせず、np.partitionでk番目のスコアを求めて候補を絞り、
+    候補だけを (スコア降順, 行番号昇順) で並べる。k番目で同点が並ぶ場合も
+    行番号の小さい行から採るので、全件を安定ソートした先頭k件と一致する。
+    """
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+    if len(scores) <= k:
+        return np.argsort(-scores, kind="stable")
+    kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+    above = np.flatnonzero(scores > kth_score)
+    ties = np.flatnonzero(scores == kth_score)[: k - len(above)]
+    candidates = np.concatenate([above, ties])
+    # lexsortは最後のキーが第1キー：スコア降順、同点は行番号昇順
+    return candidates[np.lexsort((candidates, -scores[candidates]))]
 
 
 def build_problem_search_text(problem: Dict) -> str:
@@ -82,18 +157,166 @@ def build_problem_search_text(problem: Dict) -> str:
     return " ".join([title, statement, tags, concepts]).strip()
 
 
+def dumps_json(payload) -> bytes:
+    """JSONをUTF-8のバイト列にする（日本語はエスケープしない）"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+class StaticPage:
+    """起動時に用意しておく静的ページ
+
+    小さいページはバイト列として持ち、大きいページはファイルを開いたままにして
+    os.sendfileでページキャッシュからソケットへ直接送る（Pythonでのコピーを省く）。
+    どちらの場合も内容・長さは起動時点のものとして扱うので、サーバ稼働中に
+    static/ のページを編集しないこと（反映には再起動が必要）。
+    """
+
+    def __init__(self, path: Path):
+        self.data: Optional[bytes] = None
+        self.fd: Optional[int] = None
+        if hasattr(os, "sendfile") and path.stat().st_size >= SENDFILE_MIN_SIZE:
+            self.fd = os.open(str(path), os.O_RDONLY)
+            self.size = os.fstat(self.fd).st_size
+        else:
+            self.data = path.read_bytes()
+            self.size = len(self.data)
+
+
 # -----------------------------
 # 起動時に問題文を読み込み＆ベクトル化
 # -----------------------------
-with DATA_PATH.open("r", encoding="utf-8") as f:
-    PROBLEMS: List[Dict] = json.load(f)
+def _build_bigram_csr(problems: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """全問題の2-gramインデックスを1本の配列に連結し、問題ごとの区切り位置と返す
+
+    問題iのインデックス列は all_indices[offsets[i]:offsets[i + 1]]。
+    重み付けや正規化を変えるときも、文字列からやり直さずこの配列から作れる。
+    """
+    per_problem = [
+        _char_bigram_indices(_normalize_text(build_problem_search_text(item)))
+        for item in problems
+    ]
+    offsets = np.zeros(len(per_problem) + 1, dtype=np.int32)
+    np.cumsum([len(idx) for idx in per_problem], out=offsets[1:])
+    if per_problem:
+        all_indices = np.concatenate(per_problem).astype(np.int32)
+    else:
+        all_indices = np.zeros(0, dtype=np.int32)
+    return all_indices, offsets
+
+
+def _doc_matrix_from_csr(all_indices: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """連結済みインデックスから、行ごとにL2正規化した問題ベクトル行列を作る"""
+    n_docs = len(offsets) - 1
+    rows = np.repeat(np.arange(n_docs), np.diff(offsets))
+    # (行, 列) を1次元の位置に直して、全問題ぶんを1回のbincountで数える
+    matrix = (
+        np.bincount(rows * VECTOR_SIZE + all_indices, minlength=n_docs * VECTOR_SIZE)
+        .reshape(n_docs, VECTOR_SIZE)
+        .astype(np.float32)
+    )
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def _is_valid_bigram_csr(all_indices: np.ndarray, offsets: np.ndarray, n_docs: int) -> bool:
+    """読み込んだ連結インデックスが問題数・ベクトル長と整合しているか確かめる
+
+    範囲外のインデックスがあると、行列化のときに隣の問題の行へ数えられてしまう。
+    """
+    if offsets.ndim != 1 or all_indices.ndim != 1:
+        return False
+    if not (np.issubdtype(offsets.dtype, np.integer) and np.issubdtype(all_indices.dtype, np.integer)):
+        return False
+    if len(offsets) != n_docs + 1 or offsets[0] != 0 or offsets[-1] != len(all_indices):
+        return False
+    if np.any(np.diff(offsets) < 0):
+        return False
+    if len(all_indices) and (all_indices.min() < 0 or all_indices.max() >= VECTOR_SIZE):
+        return False
+    return True
+
+
+def _load_bigram_csr(raw: bytes, problems: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """保存済みの2-gramインデックスがあれば読み込み、なければ作って保存する
+
+    キーは問題データの中身とベクトル化の設定から作るので、
+    どちらかが変われば自動的に作り直しになる。
+    """
+    key = hashlib.sha256(raw)
+    key.update(f"v{VECTORIZER_VERSION}:{VECTOR_SIZE}".encode("utf-8"))
+    cache_path = CACHE_DIR / f"bigrams_{key.hexdigest()[:16]}.npz"
+
+    try:
+        with np.load(cache_path) as saved:
+            all_indices = saved["all_indices"]
+            offsets = saved["offsets"]
+        if _is_valid_bigram_csr(all_indices, offsets, len(problems)):
+            return all_indices, offsets
+    except (OSError, EOFError, KeyError, TypeError, ValueError, zipfile.BadZipFile):
+        # 壊れた保存ファイル（空・zipでない・.npzでない等）は無視して作り直す
+        pass
+
+    all_indices, offsets = _build_bigram_csr(problems)
+    tmp_path = None
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # 同時に起動した別プロセスと書きかけのファイルを取り合わないよう、
+        # 一時ファイル名は毎回別にする
+        with tempfile.NamedTemporaryFile(
+            dir=CACHE_DIR, prefix=f"{cache_path.stem}.", suffix=".tmp", delete=False
+        ) as out:
+            tmp_path = Path(out.name)
+            np.savez(out, all_indices=all_indices, offsets=offsets)
+            # 置き換え後に中身が空のファイルが残らないよう、先にディスクへ書き切る
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, cache_path)
+        tmp_path = None
+        _prune_stale_caches(cache_path)
+    except OSError:
+        # 保存できなくても検索自体は動くので、そのまま続行する
+        pass
+    finally:
+        if tmp_path is not None:
+            tmp_path.unlink(missing_ok=True)
+    return all_indices, offsets
+
+
+def _prune_stale_caches(keep: Path) -> None:
+    """問題データの変更で使われなくなった古い保存ファイルを消す"""
+    for stale in CACHE_DIR.glob("bigrams_*.npz"):
+        if stale != keep:
+            try:
+                stale.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+
+DATA_BYTES = DATA_PATH.read_bytes()
+PROBLEMS: List[Dict] = json.loads(DATA_BYTES.decode("utf-8"))
 
 PROBLEMS_BY_ID: Dict[str, Dict] = {str(item.get("id", "")): item for item in PROBLEMS}
 
-PROBLEM_VECTORS = [
-    {"id": item.get("id"), "vector": text_to_vector(build_problem_search_text(item))}
-    for item in PROBLEMS
-]
+# 検索時は全問題のベクトルを1つの行列にまとめ、行列×ベクトル1回で採点する。
+# float16/int8に落とすとNumPyではBLASが使えず逆に遅くなるため、float32のまま持つ。
+# 結果の組み立てに使う項目は行番号で引ける並列リストとして持つ。
+ALL_INDICES, OFFSETS = _load_bigram_csr(DATA_BYTES, PROBLEMS)
+DOC_MATRIX = _doc_matrix_from_csr(ALL_INDICES, OFFSETS)
+DOC_IDS: List[str] = [item.get("id", "") for item in PROBLEMS]
+DOC_TITLES: List[str] = [item.get("title", "(無題)") for item in PROBLEMS]
+DOC_TAGS: List[List[str]] = [item.get("tags") or [] for item in PROBLEMS]
+
+
+# 静的ページと定型レスポンスは起動時に一度だけ用意しておく
+INDEX_PAGE = StaticPage(INDEX_PATH)
+PROBLEM_PAGE = StaticPage(PROBLEM_PAGE_PATH)
+EMPTY_RESULTS_JSON = b"[]"
+NOT_FOUND_JSON = dumps_json({"error": "not found"})
+PROBLEM_NOT_FOUND_JSON = dumps_json({"error": "problem not found"})
 
 
 # -----------------------------
@@ -102,58 +325,84 @@ PROBLEM_VECTORS = [
 class AppHandler(BaseHTTPRequestHandler):
     """最小のHTTPハンドラ"""
 
-    def _send_json(self, payload, status=HTTPStatus.OK):
-        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    def _send_bytes(self, data: bytes, content_type: str, status=HTTPStatus.OK):
         self.send_response(status)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Type", content_type)
         self.send_header("Content-Length", str(len(data)))
         self.end_headers()
         self.wfile.write(data)
 
-    def _send_html(self, html: str, status=HTTPStatus.OK):
-        data = html.encode("utf-8")
+    def _send_json_bytes(self, data: bytes, status=HTTPStatus.OK):
+        self._send_bytes(data, "application/json; charset=utf-8", status)
+
+    def _send_json(self, payload, status=HTTPStatus.OK):
+        self._send_json_bytes(dumps_json(payload), status)
+
+    def _send_page(self, page: StaticPage, status=HTTPStatus.OK):
+        if page.data is not None:
+            self._send_bytes(page.data, "text/html; charset=utf-8", status)
+            return
+
+        size = page.size
         self.send_response(status)
         self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Content-Length", str(size))
         self.end_headers()
-        self.wfile.write(data)
+        # sendfileは一度で全部送れるとは限らないので、残りがなくなるまで繰り返す
+        out_fd = self.connection.fileno()
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(out_fd, page.fd, offset, size - offset)
+            if sent == 0:
+                # 起動後にファイルが縮められた。Content-Lengthは送信済みなので、
+                # 黙って打ち切らずエラーにして接続を閉じさせる
+                raise ConnectionError(
+                    f"static page shrank after startup: {offset}/{size} bytes sent"
+                )
+            offset += sent
 
     def do_GET(self):  # noqa: N802 (BaseHTTPRequestHandlerのAPIに合わせる)
         parsed = urlparse(self.path)
 
         # ルートは検索ページ
         if parsed.path == "/" or parsed.path == "/index.html":
-            self._send_html(INDEX_PATH.read_text(encoding="utf-8"))
+            self._send_page(INDEX_PAGE)
             return
 
         # 問題詳細ページ
         if parsed.path.startswith("/problems/"):
-            self._send_html(PROBLEM_PAGE_PATH.read_text(encoding="utf-8"))
+            self._send_page(PROBLEM_PAGE)
             return
 
         # 検索API
         if parsed.path == "/api/search":
             query = parse_qs(parsed.query).get("q", [""])[0].strip()
-            if not query:
-                self._send_json([])
+            # 2文字未満では2-gramが作れず意味のある順位にならないので採点しない
+            # （入力途中のキー入力ごとに来るリクエストもここで返す）
+            if len(_normalize_text(query)) < 2:
+                self._send_json_bytes(EMPTY_RESULTS_JSON)
                 return
 
-            query_vec = text_to_vector(query)
-
-            scored = []
-            for item in PROBLEM_VECTORS:
-                problem = PROBLEMS_BY_ID.get(str(item.get("id")), {})
-                scored.append(
-                    {
-                        "id": problem.get("id", ""),
-                        "title": problem.get("title", "(無題)"),
-                        "tags": problem.get("tags") or [],
-                        "score": cosine_similarity(query_vec, item["vector"]),
-                    }
-                )
+            query_vec = text_to_vector_unnormalized(query)
+            scores = DOC_MATRIX.dot(query_vec)
+            top = top_k_indices(scores, TOP_K)
+            # 返す上位件数ぶんだけ検索文の長さで割り、コサイン類似度に戻す
+            squared = float(np.dot(query_vec, query_vec))
+            inv_norm = 1.0 / math.sqrt(squared) if squared > 0.0 else 1.0
+            top_scores = (scores[top] * inv_norm).tolist()
+
+            # 辞書は上位件数ぶんだけ作る（並列リストとスコアを行番号で引く）
+            ids, titles, tags = DOC_IDS, DOC_TITLES, DOC_TAGS
+            results = [
+                {"id": ids[i], "title": titles[i], "tags": tags[i], "score": score}
+                for i, score in zip(top.tolist(), top_scores)
+            ]
+            self._send_json(results)
+            return
 
-            scored.sort(key=lambda x: x["score"], reverse=True)
-            self._send_json(scored[:TOP_K])
+        # デバッグ用：検索文ベクトルのキャッシュ状況
+        if parsed.path == "/api/debug/cache":
+            self._send_json(text_to_vector_unnormalized.cache_info()._asdict())
             return
 
         # 問題詳細API
@@ -161,18 +410,22 @@ class AppHandler(BaseHTTPRequestHandler):
             problem_id = unquote(parsed.path.replace("/api/problems/", "", 1)).strip()
             problem = PROBLEMS_BY_ID.get(problem_id)
             if not problem:
-                self._send_json({"error": "problem not found"}, status=HTTPStatus.NOT_FOUND)
+                self._send_json_bytes(PROBLEM_NOT_FOUND_JSON, status=HTTPStatus.NOT_FOUND)
                 return
             self._send_json(problem)
             return
 
         # それ以外は404
-        self._send_json({"error": "not found"}, status=HTTPStatus.NOT_FOUND)
+        self._send_json_bytes(NOT_FOUND_JSON, status=HTTPStatus.NOT_FOUND)
 
 
 def run():
-    """サーバ起動"""
-    server = HTTPServer((HOST, PORT), AppHandler)
+    """サーバ起動
+
+    リクエストごとにスレッドを立てる。起動後に書き換わるのはLRUキャッシュ
+    だけで、functools.lru_cacheはスレッド安全なのでロックは不要。
+    """
+    server = ThreadingHTTPServer((HOST, PORT), AppHandler)
     print(f"Serving on http://{HOST}:{PORT}")
     server.serve_forever()
 
@@ -0,0 +1,63 @@
+"""静的ページ配信（sendfile経路）の確認
+
+同梱ページは小さくsendfile経路を通らないため、しきい値を下げて確かめる。
+リポジトリ直下で `python -m unittest` または `python -m pytest` で実行する。
+"""
+
+import os
+import sys
+import threading
+import unittest
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+# app.py は相対パスでデータを読むため、リポジトリ直下から読み込む
+os.chdir(ROOT)
+sys.path.insert(0, str(ROOT))
+
+import app  # noqa: E402
+
+
+@unittest.skipUnless(hasattr(os, "sendfile"), "os.sendfile が使えない環境")
+class SendfilePageTest(unittest.TestCase):
+    def setUp(self):
+        self._saved = (app.SENDFILE_MIN_SIZE, app.INDEX_PAGE, app.PROBLEM_PAGE)
+        app.SENDFILE_MIN_SIZE = 1
+        app.INDEX_PAGE = app.StaticPage(app.INDEX_PATH)
+        app.PROBLEM_PAGE = app.StaticPage(app.PROBLEM_PAGE_PATH)
+
+        self.server = app.ThreadingHTTPServer(("127.0.0.1", 0), app.AppHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for page in (app.INDEX_PAGE, app.PROBLEM_PAGE):
+            if page.fd is not None:
+                os.close(page.fd)
+        app.SENDFILE_MIN_SIZE, app.INDEX_PAGE, app.PROBLEM_PAGE = self._saved
+
+    def _get(self, path):
+        url = f"http://127.0.0.1:{self.server.server_address[1]}{path}"
+        with urllib.request.urlopen(url) as res:
+            return res.headers, res.read()
+
+    def test_pages_are_sent_with_sendfile(self):
+        self.assertIsNotNone(app.INDEX_PAGE.fd)
+        self.assertIsNotNone(app.PROBLEM_PAGE.fd)
+
+    def test_body_matches_file_byte_for_byte(self):
+        for path, file_path in [
+            ("/", app.INDEX_PATH),
+            ("/problems/gas_ideal_001", app.PROBLEM_PAGE_PATH),
+        ]:
+            expected = file_path.read_bytes()
+            headers, body = self._get(path)
+            self.assertEqual(body, expected)
+            self.assertEqual(int(headers["Content-Length"]), len(expected))
+
+
+if __name__ == "__main__":
+    unittest.main()